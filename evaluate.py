@@ -2,51 +2,125 @@
 Evaluation script to calculate accuracy metrics.
 Compares output.json against ground_truth.json.
 """
-import json
-from typing import Any
+import argparse
+import sys
+from itertools import islice
+from typing import Any, Dict, List, Optional
+from json_utils import load_json
+
+# Number of failing email IDs kept (and shown) per field
+MAX_ERRORS_SHOWN = 5
+
+# Report layout (fixed, so the rules and table header are built once)
+FIELD_WIDTH = 30
+ACCURACY_WIDTH = 15
+REPORT_WIDTH = 60
+_RULE = "=" * REPORT_WIDTH
+_THIN_RULE = "-" * REPORT_WIDTH
+_TABLE_HEADER = f"{'Field':<{FIELD_WIDTH}} {'Accuracy':<{ACCURACY_WIDTH}} {'Correct/Total'}"
+_OVERALL_LABEL = "OVERALL ACCURACY".ljust(FIELD_WIDTH)
+
+
+def _normalize_text(value: str) -> str:
+    """Casefold and strip a string."""
+    # Fast path: ASCII lowercase without surrounding whitespace is already normalized
+    if value.isascii() and value.islower() and value == value.strip():
+        return value
+    return value.casefold().strip()
+
+
+def _normalize_value(value: Any) -> Any:
+    """
+    Normalize a field value so matching values compare equal with a plain ==.
+    Strings are casefolded and stripped, numbers (and booleans) rounded to 2 decimals.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return _normalize_text(value)
+    if isinstance(value, (int, float)):
+        return round(float(value), 2)
+    # Any other type never matches
+    return object()
+
+
+def _normalize_str(value: Any) -> Any:
+    """Normalizer for string fields: the expected type is checked first."""
+    if type(value) is str:
+        return _normalize_text(value)
+    return _normalize_value(value)
+
+
+def _normalize_float2(value: Any) -> Any:
+    """Normalizer for numeric fields: the expected type is checked first."""
+    if type(value) is float:
+        return round(value, 2)
+    return _normalize_value(value)
+
+
+def _normalize_bool(value: Any) -> Any:
+    """Normalizer for boolean fields (booleans compare like the numbers 1.0 / 0.0)."""
+    if value is True:
+        return 1.0
+    if value is False:
+        return 0.0
+    return _normalize_value(value)
+
+
+# Per-field normalizer, chosen once from the field's expected type
+FIELD_NORMALIZERS = {
+    "product_line": _normalize_str,
+    "origin_port_code": _normalize_str,
+    "origin_port_name": _normalize_str,
+    "destination_port_code": _normalize_str,
+    "destination_port_name": _normalize_str,
+    "incoterm": _normalize_str,
+    "cargo_weight_kg": _normalize_float2,
+    "cargo_cbm": _normalize_float2,
+    "is_dangerous": _normalize_bool,
+}
+
+
+def _normalize_record(record: Dict, fields: List[str]) -> Dict:
+    """Normalize every evaluated field of a record once."""
+    return {field: FIELD_NORMALIZERS.get(field, _normalize_value)(record.get(field))
+            for field in fields}
 
 
 def compare_field(predicted: Any, ground_truth: Any, field_name: str) -> bool:
-    """Compare a single field value."""
+    """
+    Compare a single field value.
+    Nulls match only nulls, strings match case-insensitively (whitespace-trimmed),
+    numbers match after rounding to 2 decimals.
+    """
     pred_val = predicted.get(field_name)
     truth_val = ground_truth.get(field_name)
 
-    # Handle nulls
-    if pred_val is None and truth_val is None:
+    # Fast path: identical strings (most port codes / incoterms) need no normalization
+    if isinstance(pred_val, str) and pred_val == truth_val:
         return True
-    if pred_val is None or truth_val is None:
-        return False
 
-    # String comparison (case-insensitive, whitespace-trimmed)
-    if isinstance(pred_val, str) and isinstance(truth_val, str):
-        return pred_val.lower().strip() == truth_val.lower().strip()
+    normalize = FIELD_NORMALIZERS.get(field_name, _normalize_value)
+    return normalize(pred_val) == normalize(truth_val)
 
-    # Float comparison (with rounding to 2 decimals)
-    if isinstance(pred_val, (int, float)) and isinstance(truth_val, (int, float)):
-        return round(float(pred_val), 2) == round(float(truth_val), 2)
 
-    # Boolean comparison
-    if isinstance(pred_val, bool) and isinstance(truth_val, bool):
-        return pred_val == truth_val
-
-    return False
-
-
-def evaluate():
-    """Calculate and display accuracy metrics."""
-    print("Loading files...")
+def evaluate(quiet: bool = False) -> Optional[float]:
+    """
+    Calculate and display accuracy metrics.
+    Returns the overall accuracy in percent (None if output.json is missing).
+    With quiet=True only that number is printed (no tables), for scripted runs;
+    errors and warnings always go to stderr.
+    """
+    if not quiet:
+        print("Loading files...")
     try:
-        with open("output.json", "r") as f:
-            predictions = json.load(f)
+        predictions = load_json("output.json")
     except FileNotFoundError:
-        print("Error: output.json not found. Run extract.py first.")
-        return
+        print("Error: output.json not found. Run extract.py first.", file=sys.stderr)
+        return None
 
-    with open("ground_truth.json", "r") as f:
-        ground_truth = json.load(f)
-
-    # Create lookup by ID
-    truth_dict = {item["id"]: item for item in ground_truth}
+    # Create lookup by ID straight from the parsed file (no list kept alive)
+    truth_dict = {item["id"]: item for item in load_json("ground_truth.json")}
 
     # Fields to evaluate (excluding "id")
     fields = [
@@ -61,65 +135,80 @@ def evaluate():
         "is_dangerous"
     ]
 
-    # Calculate accuracy per field
-    field_accuracies = {field: {"correct": 0, "total": 0} for field in fields}
-    total_correct = 0
-    total_fields = 0
-
-    # Track which emails had errors
-    email_errors = {field: [] for field in fields}
-
+    # Align each prediction with its ground truth once (normalizing both sides up front)
+    rows = []
     for pred in predictions:
-        email_id = pred["id"]
-        truth = truth_dict.get(email_id, {})
-
+        truth = truth_dict.get(pred["id"], {})
         if not truth:
-            print(f"Warning: No ground truth found for {email_id}")
+            print(f"Warning: No ground truth found for {pred['id']}", file=sys.stderr)
             continue
+        rows.append((pred["id"], _normalize_record(pred, fields),
+                     _normalize_record(truth, fields)))
 
-        for field in fields:
-            field_accuracies[field]["total"] += 1
-            if compare_field(pred, truth, field):
-                field_accuracies[field]["correct"] += 1
-                total_correct += 1
-            else:
-                email_errors[field].append(email_id)
-            total_fields += 1
-
-    # Print results
-    print("\n" + "="*60)
-    print("ACCURACY METRICS")
-    print("="*60)
-    print(f"{'Field':<30} {'Accuracy':<15} {'Correct/Total'}")
-    print("-"*60)
+    # Calculate accuracy per field (one column at a time over the aligned rows)
+    field_accuracies = {}
+    email_errors = {}  # First MAX_ERRORS_SHOWN failing IDs per field
+    error_counts = {}
+    total_correct = 0
+    total_fields = 0
+
+    for field in fields:
+        mismatches = (email_id for email_id, pred, truth in rows
+                      if pred[field] != truth[field])
+        # Track which emails had errors (keep the first few, just count the rest)
+        email_errors[field] = list(islice(mismatches, MAX_ERRORS_SHOWN))
+        error_counts[field] = len(email_errors[field]) + \
+            sum(1 for _ in mismatches)
+        correct = len(rows) - error_counts[field]
+        field_accuracies[field] = {"correct": correct, "total": len(rows)}
+        total_correct += correct
+        total_fields += len(rows)
+
+    overall_accuracy = (total_correct / total_fields) * \
+        100 if total_fields > 0 else 0
+    if quiet:
+        print(f"{overall_accuracy:.1f}")
+        return overall_accuracy
+
+    # Build the report and write it in one go
+    lines = []
+    emit = lines.append
+    emit("\n" + _RULE)
+    emit("ACCURACY METRICS")
+    emit(_RULE)
+    emit(_TABLE_HEADER)
+    emit(_THIN_RULE)
 
     for field, stats in field_accuracies.items():
         accuracy = (stats["correct"] / stats["total"]) * \
             100 if stats["total"] > 0 else 0
-        print(
-            f"{field:<30} {accuracy:>6.1f}%        {stats['correct']}/{stats['total']}")
+        emit(
+            f"{field.ljust(FIELD_WIDTH)} {accuracy:>6.1f}%        {stats['correct']}/{stats['total']}")
 
-    overall_accuracy = (total_correct / total_fields) * \
-        100 if total_fields > 0 else 0
-    print("-"*60)
-    print(f"{'OVERALL ACCURACY':<30} {overall_accuracy:>6.1f}%        {total_correct}/{total_fields}")
-    print("="*60)
+    emit(_THIN_RULE)
+    emit(f"{_OVERALL_LABEL} {overall_accuracy:>6.1f}%        {total_correct}/{total_fields}")
+    emit(_RULE)
 
     # Show emails with errors (top 5 per field)
-    print("\n" + "="*60)
-    print("EMAILS WITH ERRORS (Top 5 per field)")
-    print("="*60)
+    emit("\n" + _RULE)
+    emit("EMAILS WITH ERRORS (Top 5 per field)")
+    emit(_RULE)
     for field, error_emails in email_errors.items():
-        if error_emails:
-            accuracy = field_accuracies[field]["correct"] / \
-                field_accuracies[field]["total"]
-            if accuracy < 1.0:  # Only show if there are errors
-                print(f"\n{field} ({len(error_emails)} errors):")
-                for email_id in error_emails[:5]:
-                    print(f"  - {email_id}")
-                if len(error_emails) > 5:
-                    print(f"  ... and {len(error_emails) - 5} more")
+        if error_emails:  # Only show if there are errors
+            emit(f"\n{field} ({error_counts[field]} errors):")
+            for email_id in error_emails:
+                emit(f"  - {email_id}")
+            if error_counts[field] > len(error_emails):
+                emit(f"  ... and {error_counts[field] - len(error_emails)} more")
+
+    sys.stdout.write("\n".join(lines) + "\n")
+    return overall_accuracy
 
 
 if __name__ == "__main__":
-    evaluate()
+    parser = argparse.ArgumentParser(
+        description="Compare output.json against ground_truth.json.")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="print only the overall accuracy")
+    args = parser.parse_args()
+    evaluate(quiet=args.quiet)
@@ -2,111 +2,380 @@
 Main extraction script.
 Processes emails using Groq LLM API with retry logic and post-processing.
 """
-import json
+import hashlib
 import os
+import pickle
+import random
 import time
 import re
-from typing import Dict, List, Tuple, Optional
-from groq import Groq
+import threading
+from collections import defaultdict, deque
+from dataclasses import astuple, dataclass
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, FrozenSet, List, Set, Tuple, Optional
+from groq import Groq, RateLimitError
 from dotenv import load_dotenv
-from schemas import ShipmentExtraction
-from prompts import create_extraction_prompt_v1, create_extraction_prompt_v2, create_extraction_prompt_v3
+from schemas import ShipmentExtraction, select_shipment_fields, validate_shipment
+from json_utils import JSONDecodeError, dumps, load_json, loads, save_json
+from prompts import create_extraction_prompt_v1, create_extraction_prompt_v2, create_extraction_prompt_v3, create_batch_extraction_prompt_v3
 
 # Prompt version to use (change this for iterative testing)
 PROMPT_VERSION = "v3"  # Options: "v1", "v2", "v3"
 
-# Load environment variables
-load_dotenv()
+# Output validation: "fast" = lightweight dict validator, "strict" = full Pydantic model,
+# "off" = only select the output fields (no type checks)
+VALIDATION_MODE = "fast"  # Options: "fast", "strict", "off"
+
+# Concurrency and rate limiting (tune to your Groq account limits)
+MAX_CONCURRENT_REQUESTS = 5  # In-flight LLM calls at once
+REQUESTS_PER_MINUTE = 30  # Request rate limit (free tier RPM)
+TOKENS_PER_MINUTE = 12000  # Rolling prompt+completion token budget (free tier TPM)
+RATE_LIMIT_TRIP = 5  # Consecutive 429s (across all workers) that halve MAX_CONCURRENT_REQUESTS
+BATCH_SIZE = 1  # Emails per LLM request (v3 only); >1 packs several emails into one prompt
+MAX_BODY_CHARS = 4000  # Email body is trimmed to this length in prompts
+
+# LLM response cache (delete the directory to force fresh API calls)
+USE_LLM_CACHE = True
+LLM_CACHE_DIR = "cache"
+
+# Load environment variables (skip reading .env when the key is already exported)
+if not os.environ.get("GROQ_API_KEY"):
+    load_dotenv()
 
 # Initialize Groq client
 client = Groq(api_key=os.getenv("GROQ_API_KEY"))
 
 
-def load_port_reference(file_path: str = "port_codes_reference.json") -> Tuple[Dict[str, str], Dict[str, str], Dict[str, List[str]]]:
+class ExtractionStopped(Exception):
+    """Raised in worker threads once the run is stopping (interrupt or failed email)."""
+
+
+# Set by main() on interrupt or error: waiting workers wake up and no new attempts start
+stop_event = threading.Event()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+    Refills `rate` tokens per second up to `capacity`; acquire() blocks until a token is available
+    (or raises ExtractionStopped once stop_event is set).
+    """
+
+    def __init__(self, rate: float, capacity: int, stop_event: threading.Event):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+        self.stop_event = stop_event
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            if self.stop_event.wait(wait_time):
+                raise ExtractionStopped()
+
+
+class TokenBudget:
+    """
+    Thread-safe tokens-per-minute limiter over a rolling 60s window.
+    reserve() blocks until an estimated cost fits the budget (or raises ExtractionStopped once
+    stop_event is set); record() swaps in the real usage.
+    """
+
+    def __init__(self, tokens_per_minute: int, stop_event: threading.Event, window: float = 60.0):
+        self.tokens_per_minute = tokens_per_minute
+        self.window = window
+        self.events = deque()  # [timestamp, tokens] entries, oldest first
+        self.lock = threading.Lock()
+        self.stop_event = stop_event
+
+    def reserve(self, estimated_tokens: int) -> list:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.events and self.events[0][0] <= now - self.window:
+                    self.events.popleft()
+                used = sum(tokens for _, tokens in self.events)
+                # An empty window always admits one request, even an oversized one
+                if not self.events or used + estimated_tokens <= self.tokens_per_minute:
+                    entry = [now, estimated_tokens]
+                    self.events.append(entry)
+                    return entry
+                wait_time = self.events[0][0] + self.window - now
+            if self.stop_event.wait(wait_time):
+                raise ExtractionStopped()
+
+    def record(self, entry: list, actual_tokens: int) -> None:
+        with self.lock:
+            entry[1] = actual_tokens
+
+
+class RequestSlots:
+    """
+    Caps in-flight LLM calls (use as a context manager around a call).
+    Circuit breaker: after `trip_after` consecutive rate-limit errors across all workers,
+    the limit is halved for the rest of the run (never below 1).
+    """
+
+    def __init__(self, limit: int, trip_after: int):
+        self.limit = limit
+        self.trip_after = trip_after
+        self.consecutive_rate_limits = 0
+        self.to_retire = 0  # Slots to drop as in-flight calls finish
+        self.slots = threading.Semaphore(limit)
+        self.lock = threading.Lock()
+
+    def __enter__(self) -> "RequestSlots":
+        self.slots.acquire()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        with self.lock:
+            if self.to_retire > 0:
+                # Retire this slot by not giving it back
+                self.to_retire -= 1
+                return
+        self.slots.release()
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.consecutive_rate_limits = 0
+
+    def record_rate_limit(self) -> None:
+        with self.lock:
+            self.consecutive_rate_limits += 1
+            if self.consecutive_rate_limits < self.trip_after or self.limit == 1:
+                return
+            self.consecutive_rate_limits = 0
+            retired = self.limit - max(1, self.limit // 2)
+            self.limit -= retired
+            self.to_retire += retired
+        print(
+            f"  {self.trip_after} rate limit errors in a row, lowering concurrency to {self.limit}")
+
+
+# Shared across worker threads: the bucket paces request starts, the budget caps tokens/minute,
+# the slots cap in-flight calls
+rate_limiter = TokenBucket(REQUESTS_PER_MINUTE / 60, MAX_CONCURRENT_REQUESTS, stop_event)
+token_budget = TokenBudget(TOKENS_PER_MINUTE, stop_event)
+request_slots = RequestSlots(MAX_CONCURRENT_REQUESTS, RATE_LIMIT_TRIP)
+
+# Precompiled patterns used on every email (case-insensitive, so they run on the raw body)
+_RT_RE = re.compile(r'(\d+(?:\.\d+)?)\s*rt', re.IGNORECASE)
+_KG_RE = re.compile(r'(\d+(?:,\d+)?(?:\.\d+)?)\s*kg', re.IGNORECASE)
+_COMMA_KG_RE = re.compile(r'(\d{1,3}(?:,\d{3})+)\s*(?:kg|kgs)', re.IGNORECASE)
+_PLAIN_KG_RE = re.compile(r'(\d+)\s*(?:kg|kgs)', re.IGNORECASE)
+_OR_RE = re.compile(r'(\w+)\s+or\s+(\w+)', re.IGNORECASE)
+_SLASH_RE = re.compile(r'(\w+)/(\w+)', re.IGNORECASE)
+# Resume only needs the "id" of each checkpoint line, so scan raw bytes instead of parsing JSON
+_ID_RE = re.compile(rb'"id"\s*:\s*"([^"]+)"')
+
+# Prompt-side body cleanup
+_CRLF_RE = re.compile(r'\r\n?')
+_QUOTE_RE = re.compile(r'^>+ ?', re.MULTILINE)
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
+
+
+# Common abbreviations: every port whose name contains the city also answers to these
+_ABBREVIATIONS = {
+    "hong kong": ["hk", "hkg"],
+    "shanghai": ["sha"],
+    "singapore": ["sin", "sg"],
+    "surabaya": ["sub"],
+    "ho chi minh": ["hcm", "sgn"],
+    "cape town": ["cpt"],
+    "houston": ["hou"],
+    "manila": ["mnl"],
+    "busan": ["pus"],
+    "jebel ali": ["jbl", "dxb"],
+    "keelung": ["kel"],
+    "yokohama": ["yok"],
+    "hamburg": ["ham"],
+    "chennai": ["maa", "madras"],
+    "bangalore": ["blr"],
+    "hyderabad": ["hyd"],
+    "guangzhou": ["can", "gzg"],
+    "shenzhen": ["szx", "szn"],
+    "xingang": ["txg"],
+    "tianjin": ["tsn"],
+    "qingdao": ["tao"],
+    "osaka": ["osa"],
+    "genoa": ["goa"],
+    "izmir": ["izm"],
+    "ambarli": ["amr"],
+    "laem chabang": ["lch"],
+    "bangkok": ["bkk"],
+    "nhava sheva": ["nsva", "nsh"],
+    "mundra": ["mun"],
+    "colombo": ["cmb"],
+    "port klang": ["pkg", "klg"],
+    "jeddah": ["jed"],  # Saudi ports
+    "dammam": ["dam"],
+    "riyadh": ["ruh"],
+}
+
+
+# City keywords that identify a specific ICD destination name
+_ICD_CITY_KEYWORDS = {
+    'chennai': 'Chennai ICD',
+    'bangalore': 'Bangalore ICD',
+    'blr': 'Bangalore ICD',
+    'hyderabad': 'Hyderabad ICD',
+    'hyd': 'Hyderabad ICD',
+    'mundra': 'Mundra ICD',
+    'bangkok': 'Bangkok ICD',
+    'whitefield': 'ICD Whitefield',
+}
+
+
+@dataclass(frozen=True)
+class PortIndex:
+    """Name candidates for one port code, precomputed so name selection is a lookup."""
+
+    names: Tuple[str, ...]  # All reference names, in file order
+    name_set: FrozenSet[str]  # Same names, for O(1) exact-name checks
+    combined_name: Optional[str]  # First "A / B" combined name
+    india_name: Optional[str]  # First "India (...)" style name
+    icd_keyword_names: Tuple[Tuple[str, str], ...]  # (keyword, ICD name) in keyword priority order
+    fallback_icd_name: Optional[str]  # Simple ICD name, Chennai ICD preferred
+    default_name: str  # Shortest simple name (or first name)
+
+
+def build_port_index(code_to_all_names: Dict[str, Tuple[str, ...]]) -> Dict[str, PortIndex]:
+    """Precompute the name candidates get_best_port_name chooses from, once per code."""
+    port_index = {}
+    for code, all_names in code_to_all_names.items():
+        name_set = frozenset(all_names)
+        combined_names = [n for n in all_names if " / " in n]
+        simple_names = [n for n in all_names if " / " not in n]
+        india_names = [n for n in all_names if "india" in n.lower()]
+
+        icd_keyword_names = []
+        for keyword, icd_name in _ICD_CITY_KEYWORDS.items():
+            # Also accept the reverse format (ICD City)
+            reverse_name = f"ICD {icd_name.replace(' ICD', '')}"
+            if icd_name in name_set:
+                icd_keyword_names.append((keyword, icd_name))
+            elif reverse_name in name_set:
+                icd_keyword_names.append((keyword, reverse_name))
+
+        simple_icd = [n for n in simple_names if "icd" in n.lower()]
+        # Prefer "Chennai ICD" over "Bangalore ICD" for INMAA code
+        chennai_icd = [n for n in simple_icd if 'chennai' in n.lower()]
+
+        port_index[code] = PortIndex(
+            names=tuple(all_names),
+            name_set=name_set,
+            combined_name=combined_names[0] if combined_names else None,
+            india_name=india_names[0] if india_names else None,
+            icd_keyword_names=tuple(icd_keyword_names),
+            fallback_icd_name=(chennai_icd or simple_icd or [None])[0],
+            default_name=min(simple_names, key=len) if simple_names else all_names[0],
+        )
+    return port_index
+
+
+def _load_port_cache(cache_path: str, source_path: str) -> Optional[Tuple]:
+    """Return the pickled port lookups if they are newer than the JSON and this module."""
+    try:
+        if os.path.getmtime(cache_path) < max(os.path.getmtime(source_path), os.path.getmtime(__file__)):
+            return None
+        with open(cache_path, "rb") as f:
+            ports, code_to_name, name_to_code, code_to_all_names, index_fields = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError):
+        return None
+    port_index = {code: PortIndex(*fields)
+                  for code, fields in index_fields.items()}
+    return ports, code_to_name, name_to_code, code_to_all_names, port_index
+
+
+def _save_port_cache(cache_path: str, result: Tuple) -> None:
+    """Pickle the port lookups atomically; a failed write only costs a rebuild next run."""
+    ports, code_to_name, name_to_code, code_to_all_names, port_index = result
+    # PortIndex is stored as plain tuples so the pickle doesn't depend on the module name
+    index_fields = {code: astuple(index) for code, index in port_index.items()}
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump((ports, code_to_name, name_to_code, code_to_all_names, index_fields),
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+
+@lru_cache(maxsize=1)
+def load_port_reference(file_path: str = "port_codes_reference.json") -> Tuple[List[Dict], Dict[str, str], Dict[str, str], Dict[str, Tuple[str, ...]], Dict[str, PortIndex]]:
     """
     Load port codes and create lookup dictionaries.
-    Returns: (code_to_name, name_to_code, code_to_all_names)
+    Returns: (port_reference, code_to_name, name_to_code, code_to_all_names, port_index)
+    The result is pickled next to the JSON file and reused while it is newer than
+    both the JSON file and this module. Repeat calls in a process return the same
+    objects (treat them as read-only).
     """
-    with open(file_path, 'r') as f:
-        ports = json.load(f)
+    cache_path = os.path.splitext(file_path)[0] + ".pkl"
+    cached = _load_port_cache(cache_path, file_path)
+    if cached is not None:
+        return cached
 
-    code_to_name = {}  # {"HKHKG": "Hong Kong"} - preferred canonical name
-    name_to_code = {}  # {"hong kong": "HKHKG", "hk": "HKHKG"}
-    # {"INMAA": ["Chennai", "Chennai ICD", "Chennai ICD / ..."]} - all names for a code
-    code_to_all_names = {}
+    ports = load_json(file_path)
 
-    for port in ports:
-        code = port["code"]
-        name = port["name"]
+    # (code, name, normalized name) per port, in file order
+    rows = [(port["code"], port["name"], port["name"].lower().strip())
+            for port in ports]
 
-        # Store all names for each code
-        if code not in code_to_all_names:
-            code_to_all_names[code] = []
+    # {"INMAA": ["Chennai", "Chennai ICD", "Chennai ICD / ..."]} - all names for a code
+    code_to_all_names = defaultdict(list)
+    for code, name, _ in rows:
         code_to_all_names[code].append(name)
 
-        # Store canonical mapping (prefer combined names with "/" over simple names)
-        if code not in code_to_name:
+    # {"HKHKG": "Hong Kong"} - preferred canonical name: combined names (contain "/")
+    # over simple names, then longer names (usually more descriptive); ties keep the first
+    code_to_name = {}
+    name_scores = {}
+    for code, name, _ in rows:
+        score = (1 if "/" in name else 0, len(name))
+        if code not in name_scores or score > name_scores[code]:
+            name_scores[code] = score
             code_to_name[code] = name
-        else:
-            # Prefer combined names (contain "/") over simple names
-            current_name = code_to_name[code]
-            if "/" in name and "/" not in current_name:
-                code_to_name[code] = name
-            elif "/" not in name and "/" in current_name:
-                # Keep the combined name
-                pass
-            elif len(name) > len(current_name):
-                # Prefer longer names (usually more descriptive)
-                code_to_name[code] = name
-
-        # Store all name variations (lowercase for matching)
-        normalized_name = name.lower().strip()
-        name_to_code[normalized_name] = code
-
-        # Handle common abbreviations
-        abbreviations = {
-            "hong kong": ["hk", "hkg"],
-            "shanghai": ["sha"],
-            "singapore": ["sin", "sg"],
-            "surabaya": ["sub"],
-            "ho chi minh": ["hcm", "sgn"],
-            "cape town": ["cpt"],
-            "houston": ["hou"],
-            "manila": ["mnl"],
-            "busan": ["pus"],
-            "jebel ali": ["jbl", "dxb"],
-            "keelung": ["kel"],
-            "yokohama": ["yok"],
-            "hamburg": ["ham"],
-            "chennai": ["maa", "madras"],
-            "bangalore": ["blr"],
-            "hyderabad": ["hyd"],
-            "guangzhou": ["can", "gzg"],
-            "shenzhen": ["szx", "szn"],
-            "xingang": ["txg"],
-            "tianjin": ["tsn"],
-            "qingdao": ["tao"],
-            "osaka": ["osa"],
-            "genoa": ["goa"],
-            "izmir": ["izm"],
-            "ambarli": ["amr"],
-            "laem chabang": ["lch"],
-            "bangkok": ["bkk"],
-            "nhava sheva": ["nsva", "nsh"],
-            "mundra": ["mun"],
-            "colombo": ["cmb"],
-            "port klang": ["pkg", "klg"],
-            "jeddah": ["jed"],  # Saudi ports
-            "dammam": ["dam"],
-            "riyadh": ["ruh"],
-        }
-
-        for full_name, abbrevs in abbreviations.items():
-            if full_name in normalized_name:
-                for abbrev in abbrevs:
-                    name_to_code[abbrev] = code
-
-    return code_to_name, name_to_code, code_to_all_names
+
+    # {"hong kong": "HKHKG", "hk": "HKHKG"} - all name variations (lowercase for matching);
+    # a later port with the same name wins
+    name_to_code = {normalized: code for code, _, normalized in rows}
+    name_positions = {normalized: i for i, (_, _, normalized) in enumerate(rows)}
+
+    # Handle common abbreviations in one pass per city: an abbreviation points at the
+    # last port whose name contains the city, unless a later port is named exactly that
+    abbrev_positions = {}
+    for full_name, abbrevs in _ABBREVIATIONS.items():
+        position = next((i for i in range(len(rows) - 1, -1, -1)
+                         if full_name in rows[i][2]), None)
+        if position is None:
+            continue
+        for abbrev in abbrevs:
+            if abbrev_positions.get(abbrev, -1) <= position and \
+                    name_positions.get(abbrev, -1) <= position:
+                abbrev_positions[abbrev] = position
+                name_to_code[abbrev] = rows[position][0]
+
+    # Freeze name lists (smaller, and callers can't mutate the shared lookup)
+    code_to_all_names = {code: tuple(names)
+                         for code, names in code_to_all_names.items()}
+
+    result = (ports, code_to_name, name_to_code, code_to_all_names,
+              build_port_index(code_to_all_names))
+    _save_port_cache(cache_path, result)
+    return result
 
 
 def is_consolidated_inquiry(body: str) -> bool:
@@ -117,10 +386,12 @@ def is_consolidated_inquiry(body: str) -> bool:
     return ";" in body and ("→" in body or "->" in body)
 
 
-def get_consolidated_dest_order(body: str) -> List[str]:
+@lru_cache(maxsize=512)
+def get_consolidated_dest_order(body: str) -> Tuple[str, ...]:
     """
     Extract destination order from consolidated inquiry.
-    Returns list like ['MAA', 'HYD', 'BLR'] based on email body.
+    Returns tuple like ('Chennai', 'Hyderabad', 'Bangalore') based on email body.
+    Memoized per body (the tuple is immutable, so sharing cached results is safe).
     """
     order = []
     routes = body.split(";")
@@ -139,103 +410,69 @@ def get_consolidated_dest_order(body: str) -> List[str]:
             if abbrev in dest_part:
                 order.append(abbrev_map[abbrev])
                 break
-    return order
+    return tuple(order)
 
 
-def get_best_port_name(port_code: str, email_body: str, code_to_all_names: Dict[str, List[str]], is_destination: bool = False) -> Optional[str]:
+def get_best_port_name(port_code: str, email_body: str, port_index: Dict[str, PortIndex], is_destination: bool = False, is_consolidated: Optional[bool] = None) -> Optional[str]:
     """
     Select the best port name from reference based on email context.
     - For consolidated inquiries, match the destination order from email
     - If email mentions specific "City ICD", prefer that exact match
     - Default to appropriate name based on context
+    Pass is_consolidated to avoid recomputing it per call.
     """
-    if not port_code or port_code not in code_to_all_names:
+    if not port_code or port_code not in port_index:
         return None
 
-    all_names = code_to_all_names[port_code]
-    body_lower = email_body.lower()
+    index = port_index[port_code]
+    if is_consolidated is None:
+        is_consolidated = is_consolidated_inquiry(email_body)
 
     # Handle consolidated inquiries with combined names (DESTINATION ONLY)
-    if is_consolidated_inquiry(email_body) and is_destination:
+    if is_destination and is_consolidated:
         dest_order = get_consolidated_dest_order(email_body)
         if len(dest_order) >= 2:
             # Build expected combined name pattern
             expected_pattern = " / ".join(
                 [f"{city} ICD" for city in dest_order])
-            # Look for matching combined name
-            for name in all_names:
-                if name == expected_pattern:
-                    return name
+            if expected_pattern in index.name_set:
+                return expected_pattern
             # Fallback: return any combined name that starts correctly
-            combined_names = [n for n in all_names if " / " in n]
-            if combined_names:
-                return combined_names[0]
+            if index.combined_name:
+                return index.combined_name
 
     # For ORIGINS: check for combined names when email mentions multiple ports
+    # ("Shenzhen or Guangzhou", "Tianjin/Xingang")
+    if not is_destination and index.combined_name:
+        if _OR_RE.search(email_body) or _SLASH_RE.search(email_body):
+            return index.combined_name
+
+    # The remaining checks are case-insensitive and destination-only
     if not is_destination:
-        # Check for "or" pattern (e.g., "Shenzhen or Guangzhou")
-        or_pattern = re.search(r'(\w+)\s+or\s+(\w+)', body_lower)
-        if or_pattern:
-            combined_names = [n for n in all_names if " / " in n]
-            if combined_names:
-                return combined_names[0]
-        # Check for "/" pattern in origin (e.g., "Tianjin/Xingang")
-        slash_pattern = re.search(r'(\w+)/(\w+)', body_lower)
-        if slash_pattern:
-            combined_names = [n for n in all_names if " / " in n]
-            if combined_names:
-                return combined_names[0]
+        return index.default_name
+    body_lower = email_body.lower()
 
     # Check for "to India" pattern - use "India (Chennai)" format
-    if is_destination and port_code == "INMAA":
+    if port_code == "INMAA":
         if " to india" in body_lower and "icd" not in body_lower and "ppg" not in body_lower:
-            india_chennai = [n for n in all_names if "india" in n.lower()]
-            if india_chennai:
-                return india_chennai[0]
+            if index.india_name:
+                return index.india_name
 
     # Check if email mentions specific "City ICD" or "PPG" pattern (DESTINATION ONLY)
     # PPG (Paid Per Gateway) implies ICD destination
-    if is_destination and ("icd" in body_lower or "ppg" in body_lower):
-        # Map of city keywords to look for
-        city_keywords = {
-            'chennai': 'Chennai ICD',
-            'bangalore': 'Bangalore ICD',
-            'blr': 'Bangalore ICD',
-            'hyderabad': 'Hyderabad ICD',
-            'hyd': 'Hyderabad ICD',
-            'mundra': 'Mundra ICD',
-            'bangkok': 'Bangkok ICD',
-            'whitefield': 'ICD Whitefield',
-        }
-
-        # Find which city ICD is mentioned
-        for keyword, icd_name in city_keywords.items():
-            # Check if email mentions this city with ICD
-            if keyword in body_lower and 'icd' in body_lower:
-                # Verify this name exists for the port code
-                if icd_name in all_names:
+    if "icd" in body_lower or "ppg" in body_lower:
+        # Find which city ICD is mentioned (only names that exist for this code)
+        if 'icd' in body_lower:
+            for keyword, icd_name in index.icd_keyword_names:
+                if keyword in body_lower:
                     return icd_name
-                # Also check for reverse format (ICD City)
-                reverse_name = f"ICD {icd_name.replace(' ICD', '')}"
-                if reverse_name in all_names:
-                    return reverse_name
-
-        # Fallback: return first simple ICD name (not combined)
-        simple_icd = [n for n in all_names if "icd" in n.lower()
-                      and " / " not in n]
-        if simple_icd:
-            # Prefer "Chennai ICD" over "Bangalore ICD" for INMAA code
-            chennai_icd = [n for n in simple_icd if 'chennai' in n.lower()]
-            if chennai_icd:
-                return chennai_icd[0]
-            return simple_icd[0]
 
-    # Default: return shortest simple name
-    simple_names = [n for n in all_names if " / " not in n]
-    if simple_names:
-        return min(simple_names, key=len)
+        # Fallback: first simple ICD name (not combined)
+        if index.fallback_icd_name:
+            return index.fallback_icd_name
 
-    return all_names[0]
+    # Default: return shortest simple name
+    return index.default_name
 
 
 def extract_weight_from_consolidated(body: str) -> Optional[float]:
@@ -244,7 +481,7 @@ def extract_weight_from_consolidated(body: str) -> Optional[float]:
     Handles: "850kg", "600 kg", "750KG"
     """
     # Find all kg mentions
-    kg_matches = re.findall(r'(\d+(?:,\d+)?(?:\.\d+)?)\s*kg', body.lower())
+    kg_matches = _KG_RE.findall(body)
     if kg_matches:
         # Return first weight found (clean commas)
         weight_str = kg_matches[0].replace(',', '')
@@ -252,19 +489,42 @@ def extract_weight_from_consolidated(body: str) -> Optional[float]:
     return None
 
 
+def round2(value) -> float:
+    """
+    Round a number to 2 decimals.
+    Floats the LLM already returned rounded (the common case) are returned as-is, skipping
+    the float() conversion and the new object.
+    """
+    if type(value) is float:
+        rounded = round(value, 2)
+        return value if rounded == value else rounded
+    return round(float(value), 2)
+
+
+def pick_weight(current: float, parsed: float) -> float:
+    """
+    Choose between the LLM weight and a plain "N kg" weight parsed from the body.
+    A tiny LLM weight next to a much larger body weight means a comma was misinterpreted.
+    """
+    if current < 10.0 and parsed > current * 100.0:
+        return parsed
+    return current
+
+
 def post_process_extraction(
     extracted: Dict,
     email_data: Dict,
     code_to_name: Dict[str, str],
     name_to_code: Dict[str, str],
-    code_to_all_names: Dict[str, List[str]] = None
+    port_index: Dict[str, PortIndex] = None
 ) -> Dict:
     """
     Post-process LLM extraction with deterministic business rules.
     Handles: product_line, rounding, ICD names, consolidated inquiries, weight extraction.
     """
     body = email_data.get("body", "")
-    body_lower = body.lower()
+    # Checked once here, reused by weight extraction and both port name lookups
+    is_consolidated = is_consolidated_inquiry(body)
 
     # 1. Determine product_line from port codes (deterministic)
     dest_code = extracted.get("destination_port_code", "")
@@ -280,13 +540,12 @@ def post_process_extraction(
 
     # 2. Round numeric fields
     if extracted.get("cargo_weight_kg") is not None:
-        extracted["cargo_weight_kg"] = round(
-            float(extracted["cargo_weight_kg"]), 2)
+        extracted["cargo_weight_kg"] = round2(extracted["cargo_weight_kg"])
     if extracted.get("cargo_cbm") is not None:
-        extracted["cargo_cbm"] = round(float(extracted["cargo_cbm"]), 2)
+        extracted["cargo_cbm"] = round2(extracted["cargo_cbm"])
 
     # 3. Handle RT units (Revenue Ton) - RT = CBM for LCL shipments
-    rt_match = re.search(r'(\d+\.?\d*)\s*rt', body_lower)
+    rt_match = _RT_RE.search(body)
     if rt_match:
         rt_value = float(rt_match.group(1))
         # RT = CBM for LCL shipments (if CBM not already set)
@@ -294,7 +553,7 @@ def post_process_extraction(
             extracted["cargo_cbm"] = round(rt_value, 2)
 
     # 4. Handle consolidated inquiries - extract weight from any route
-    if is_consolidated_inquiry(body):
+    if is_consolidated:
         if not extracted.get("cargo_weight_kg"):
             weight = extract_weight_from_consolidated(body)
             if weight:
@@ -302,8 +561,7 @@ def post_process_extraction(
 
     # 5. Fix weight parsing for comma-separated numbers (e.g., "3,200 KGS")
     # Also look for weight with comma directly in body
-    comma_weight_match = re.search(
-        r'(\d{1,3}(?:,\d{3})+)\s*(?:kg|kgs)', body_lower)
+    comma_weight_match = _COMMA_KG_RE.search(body)
     if comma_weight_match:
         weight_str = comma_weight_match.group(1).replace(',', '')
         extracted["cargo_weight_kg"] = round(float(weight_str), 2)
@@ -312,37 +570,138 @@ def post_process_extraction(
         # Check if weight seems too small (might be comma parsing issue)
         if weight < 10:
             # Look for larger weight pattern in body
-            weight_match = re.search(r'(\d+)\s*(?:kg|kgs)', body_lower)
+            weight_match = _PLAIN_KG_RE.search(body)
             if weight_match:
-                parsed_weight = float(weight_match.group(1))
-                if parsed_weight > weight * 100:  # Likely comma was misinterpreted
-                    extracted["cargo_weight_kg"] = round(parsed_weight, 2)
+                extracted["cargo_weight_kg"] = round(
+                    pick_weight(weight, float(weight_match.group(1))), 2)
 
     # 6. Set port names using context-aware selection - ALWAYS use best contextual name
-    if extracted.get("origin_port_code") and code_to_all_names:
-        origin_code = extracted["origin_port_code"]
-        if origin_code in code_to_all_names:
-            best_name = get_best_port_name(
-                origin_code, body, code_to_all_names, is_destination=False)
-            if best_name:
-                extracted["origin_port_name"] = best_name
-    elif not extracted.get("origin_port_code"):
-        extracted["origin_port_name"] = None
-
-    if extracted.get("destination_port_code") and code_to_all_names:
-        dest_code = extracted["destination_port_code"]
-        if dest_code in code_to_all_names:
-            best_name = get_best_port_name(
-                dest_code, body, code_to_all_names, is_destination=True)
-            if best_name:
-                extracted["destination_port_name"] = best_name
-    elif not extracted.get("destination_port_code"):
-        extracted["destination_port_name"] = None
+    _resolve_port_name(extracted, "origin_port_code", "origin_port_name", body,
+                       port_index, False, is_consolidated)
+    _resolve_port_name(extracted, "destination_port_code", "destination_port_name", body,
+                       port_index, True, is_consolidated)
 
     return extracted
 
 
-def call_llm_and_parse(prompt: str, email_id: str, silent: bool = False) -> Dict:
+def _resolve_port_name(
+    extracted: Dict,
+    code_key: str,
+    name_key: str,
+    body: str,
+    port_index: Optional[Dict[str, PortIndex]],
+    is_destination: bool,
+    is_consolidated: bool
+) -> None:
+    """
+    Set extracted[name_key] to the best reference name for extracted[code_key].
+    No code clears the name; a code missing from the reference keeps the LLM's name.
+    """
+    code = extracted.get(code_key)
+    if not code:
+        extracted[name_key] = None
+    elif port_index and code in port_index:
+        best_name = get_best_port_name(
+            code, body, port_index, is_destination=is_destination,
+            is_consolidated=is_consolidated)
+        if best_name:
+            extracted[name_key] = best_name
+
+
+def _cache_key(prompt: str) -> str:
+    """
+    Content-addressed cache key for one prompt.
+    Any change to the prompt text (version, template, email) gives a new key.
+    """
+    return hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+
+
+def _read_cached_response(cache_key: str) -> Optional[Dict]:
+    """Return the cached parsed LLM response, or None on a miss (or an unreadable entry)."""
+    path = os.path.join(LLM_CACHE_DIR, f"{cache_key}.json")
+    try:
+        cached = load_json(path)
+    except (OSError, JSONDecodeError):
+        return None
+    return cached if isinstance(cached, dict) else None
+
+
+def _write_cached_response(cache_key: str, data: Dict) -> None:
+    """
+    Write a parsed LLM response to the cache atomically (safe across worker threads).
+    A failed write only costs an API call on the next run.
+    """
+    path = os.path.join(LLM_CACHE_DIR, f"{cache_key}.json")
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(dumps(data))
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def _backoff(attempt: int, error: Optional[Exception] = None) -> float:
+    """
+    Seconds to wait before retry `attempt + 1`: the server's Retry-After for rate limits
+    when given, else exponential backoff (1s, 2s, 4s) plus up to 1s of jitter so
+    workers that failed together don't retry together.
+    """
+    if isinstance(error, RateLimitError):
+        try:
+            return float(error.response.headers["retry-after"])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            pass
+    return 2 ** attempt + random.random()
+
+
+def _complete(prompt: str) -> str:
+    """
+    Send one prompt through the rate limiters and return the response text,
+    with any markdown code fence stripped.
+    The response is streamed and joined once the last chunk has arrived.
+    """
+    rate_limiter.acquire()
+    # ~4 characters per token; corrected with the real usage once the call returns
+    reservation = token_budget.reserve(len(prompt) // 4)
+    parts = []
+    usage = None
+    with request_slots:
+        try:
+            stream = client.chat.completions.create(
+                model="llama-3.3-70b-versatile",
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0,
+                stream=True
+            )
+        except RateLimitError:
+            request_slots.record_rate_limit()
+            raise
+        request_slots.record_success()
+        for chunk in stream:
+            if chunk.choices:
+                parts.append(chunk.choices[0].delta.content or "")
+            # Token usage arrives on the final chunk (under x_groq on Groq)
+            chunk_usage = getattr(chunk, "usage", None) or \
+                getattr(getattr(chunk, "x_groq", None), "usage", None)
+            if chunk_usage:
+                usage = chunk_usage
+    if usage:
+        token_budget.record(reservation, usage.total_tokens)
+
+    json_str = "".join(parts).strip()
+
+    # Remove markdown code blocks if present
+    if json_str.startswith("```"):
+        json_str = json_str.split("```")[1]
+        if json_str.startswith("json"):
+            json_str = json_str[4:]
+        json_str = json_str.strip()
+    return json_str
+
+
+def call_llm_and_parse(prompt: str, email_id: str, silent: bool = False, cache_key: Optional[str] = None) -> Dict:
     """
     Call LLM and parse JSON response with retry logic.
     Returns raw extracted data (before post-processing).
@@ -351,54 +710,55 @@ def call_llm_and_parse(prompt: str, email_id: str, silent: bool = False) -> Dict
         prompt: The prompt to send to LLM
         email_id: Email ID to add to result
         silent: If True, don't print debug messages
+        cache_key: If set, serve/store the parsed response from the on-disk cache
 
     Returns:
         Dict with extracted data (or null values on failure)
+
+    Raises:
+        ExtractionStopped: once stop_event is set (no further attempts are made)
     """
+    if cache_key:
+        cached = _read_cached_response(cache_key)
+        if cached is not None:
+            cached["id"] = email_id
+            return cached
+
     max_retries = 3
     for attempt in range(max_retries):
+        if stop_event.is_set():
+            raise ExtractionStopped()
         try:
-            response = client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0
-            )
-
             # Parse JSON response
-            json_str = response.choices[0].message.content.strip()
-
-            # Remove markdown code blocks if present
-            if json_str.startswith("```"):
-                json_str = json_str.split("```")[1]
-                if json_str.startswith("json"):
-                    json_str = json_str[4:]
-                json_str = json_str.strip()
-
-            extracted_data = json.loads(json_str)
+            extracted_data = loads(_complete(prompt))
 
             # Add email ID
             extracted_data["id"] = email_id
+            if cache_key:
+                _write_cached_response(cache_key, extracted_data)
             return extracted_data
 
-        except json.JSONDecodeError as e:
+        except ExtractionStopped:
+            raise
+        except JSONDecodeError as e:
             if not silent:
-                print(f"  JSON decode error on attempt {attempt + 1}: {e}")
+                print(
+                    f"  {email_id}: JSON decode error on attempt {attempt + 1}: {e}")
             if attempt < max_retries - 1:
-                wait_time = 2 ** attempt
-                time.sleep(wait_time)
+                stop_event.wait(_backoff(attempt))
             else:
                 if not silent:
                     print(
-                        f"  Failed to parse JSON after {max_retries} attempts")
+                        f"  {email_id}: Failed to parse JSON after {max_retries} attempts")
         except Exception as e:
             if not silent:
-                print(f"  Error on attempt {attempt + 1}: {e}")
+                print(f"  {email_id}: Error on attempt {attempt + 1}: {e}")
             if attempt < max_retries - 1:
-                wait_time = 2 ** attempt  # Exponential backoff: 1s, 2s, 4s
-                time.sleep(wait_time)
+                stop_event.wait(_backoff(attempt, e))
             else:
                 if not silent:
-                    print(f"  Failed after {max_retries} attempts")
+                    print(
+                        f"  {email_id}: Failed after {max_retries} attempts")
 
     # Return null values on failure
     return {
@@ -415,126 +775,303 @@ def call_llm_and_parse(prompt: str, email_id: str, silent: bool = False) -> Dict
     }
 
 
+# Prompt builder per PROMPT_VERSION (unknown versions use v3)
+_PROMPT_BUILDERS = {
+    "v1": create_extraction_prompt_v1,
+    "v2": create_extraction_prompt_v2,
+    "v3": create_extraction_prompt_v3,
+}
+
+
+def _clean_body(body: str) -> str:
+    """
+    Shrink an email body for the prompt: normalize line endings, drop ">" quote markers
+    of forwarded threads, collapse blank-line runs and cap the length at MAX_BODY_CHARS.
+    Post-processing still sees the original body.
+    """
+    body = _CRLF_RE.sub("\n", body)
+    body = _QUOTE_RE.sub("", body)
+    body = _BLANK_LINES_RE.sub("\n\n", body)
+    return body.strip()[:MAX_BODY_CHARS]
+
+
 def extract_single_email(
     email_data: Dict,
     port_reference: List[Dict],
     code_to_name: Dict[str, str],
     name_to_code: Dict[str, str],
-    code_to_all_names: Dict[str, List[str]]
+    port_index: Dict[str, PortIndex]
 ) -> Dict:
     """
     Extract shipment details from one email using LLM.
     """
     # 1. Prepare prompt (select version)
-    if PROMPT_VERSION == "v1":
-        prompt = create_extraction_prompt_v1(
-            email_data["subject"], email_data["body"], port_reference)
-    elif PROMPT_VERSION == "v2":
-        prompt = create_extraction_prompt_v2(
-            email_data["subject"], email_data["body"], port_reference)
-    else:
-        prompt = create_extraction_prompt_v3(
-            email_data["subject"], email_data["body"], port_reference)
+    build_prompt = _PROMPT_BUILDERS.get(PROMPT_VERSION, create_extraction_prompt_v3)
+    prompt = build_prompt(
+        email_data["subject"], _clean_body(email_data["body"]), port_reference)
 
     # 2. Call LLM and parse (using helper function)
-    extracted_data = call_llm_and_parse(prompt, email_data["id"])
+    cache_key = _cache_key(prompt) if USE_LLM_CACHE else None
+    extracted_data = call_llm_and_parse(
+        prompt, email_data["id"], cache_key=cache_key)
+
+    # 3-4. Post-process and validate
+    return finalize_extraction(
+        extracted_data, email_data, code_to_name, name_to_code, port_index)
+
 
-    # 3. Post-process
+def finalize_extraction(
+    extracted_data: Dict,
+    email_data: Dict,
+    code_to_name: Dict[str, str],
+    name_to_code: Dict[str, str],
+    port_index: Dict[str, PortIndex]
+) -> Dict:
+    """
+    Post-process a raw LLM extraction and validate it into the output dict.
+    """
+    # Post-process
     extracted_data = post_process_extraction(
         extracted_data,
         email_data,
         code_to_name,
         name_to_code,
-        code_to_all_names
+        port_index
     )
 
-    # 4. Validate with Pydantic
-    shipment = ShipmentExtraction(**extracted_data)
+    # Validate and convert to dict for JSON output
+    if VALIDATION_MODE == "strict":
+        return ShipmentExtraction.model_validate(extracted_data).model_dump()
+    if VALIDATION_MODE == "off":
+        return select_shipment_fields(extracted_data)
+    return validate_shipment(extracted_data)
+
+
+def call_llm_and_parse_batch(prompt: str, email_ids: List[str]) -> Optional[List[Dict]]:
+    """
+    Call LLM once for a batch prompt and parse the JSON array response.
+    Returns one raw extraction per email ID (in order), or None if the response
+    is unusable so the caller can fall back to one request per email.
+    """
+    try:
+        rows = loads(_complete(prompt))
+    except ExtractionStopped:
+        raise
+    except Exception as e:
+        print(f"  {email_ids[0]}..{email_ids[-1]}: Batch request failed: {e}")
+        return None
+
+    if not isinstance(rows, list) or len(rows) != len(email_ids) or \
+            not all(isinstance(row, dict) for row in rows):
+        print(
+            f"  {email_ids[0]}..{email_ids[-1]}: Batch response does not have {len(email_ids)} objects")
+        return None
+
+    for row, email_id in zip(rows, email_ids):
+        row["id"] = email_id
+    return rows
+
+
+def extract_email_batch(
+    batch: List[Dict],
+    port_reference: List[Dict],
+    code_to_name: Dict[str, str],
+    name_to_code: Dict[str, str],
+    port_index: Dict[str, PortIndex]
+) -> List[Dict]:
+    """
+    Extract shipment details from several emails with a single LLM call.
+    Emails the batch call cannot cover are extracted one by one instead.
+    """
+    if len(batch) == 1:
+        return [extract_single_email(
+            batch[0], port_reference, code_to_name, name_to_code, port_index)]
+
+    # 1. Serve cached rows, keyed by each email's one-email batch prompt (so batch
+    # answers don't mix with single-email ones and survive a different batch split)
+    prompt_emails = [dict(email_data, body=_clean_body(email_data["body"]))
+                     for email_data in batch]
+    cache_keys = [_cache_key(create_batch_extraction_prompt_v3([email_data], port_reference))
+                  if USE_LLM_CACHE else None
+                  for email_data in prompt_emails]
+    raw_rows = [_read_cached_response(key) if key else None for key in cache_keys]
+    missing = [i for i, row in enumerate(raw_rows) if row is None]
+
+    # 2. One LLM call for everything not cached
+    if missing:
+        prompt = create_batch_extraction_prompt_v3(
+            [prompt_emails[i] for i in missing], port_reference)
+        parsed = call_llm_and_parse_batch(prompt, [batch[i]["id"] for i in missing])
+        if parsed is not None:
+            for i, row in zip(missing, parsed):
+                if cache_keys[i]:
+                    _write_cached_response(cache_keys[i], row)
+                raw_rows[i] = row
+
+    # 3. Post-process and validate (falling back to single-email extraction)
+    results = []
+    for email_data, row in zip(batch, raw_rows):
+        if row is None:
+            results.append(extract_single_email(
+                email_data, port_reference, code_to_name, name_to_code, port_index))
+        else:
+            row["id"] = email_data["id"]
+            results.append(finalize_extraction(
+                row, email_data, code_to_name, name_to_code, port_index))
+    return results
+
 
-    # 5. Convert to dict for JSON output
-    return shipment.model_dump()
+def load_checkpoint_ids(checkpoint_path: str) -> Set[str]:
+    """
+    Collect the IDs already processed from a JSONL checkpoint without parsing the records.
+    A crash mid-write can leave a truncated last line; it is cut off so appends start clean.
+    """
+    with open(checkpoint_path, "rb+") as f:
+        data = f.read()
+        complete_end = data.rfind(b"\n") + 1
+        if complete_end < len(data):
+            f.truncate(complete_end)
+            data = data[:complete_end]
+    return {m.group(1).decode() for m in _ID_RE.finditer(data)}
+
+
+def materialize_output(checkpoint_path: str, output_path: str, emails: List[Dict]) -> int:
+    """
+    Convert the JSONL checkpoint into the final output.json in one pass.
+    Records are ordered like the input emails (completion order is not deterministic).
+    Returns the number of records written.
+    """
+    by_id = {}
+    with open(checkpoint_path, "rb") as f:
+        for line in f:
+            try:
+                record = loads(line)
+            except JSONDecodeError:
+                continue
+            by_id[record["id"]] = record
+
+    order = {email["id"]: i for i, email in enumerate(emails)}
+    results = sorted(by_id.values(), key=lambda r: order.get(r["id"], len(order)))
+    save_json(results, output_path)
+    return len(results)
 
 
 def main():
     """Main function to process all emails."""
     # 1. Load input data
     print("Loading input data...")
-    with open("emails_input.json", "r") as f:
-        emails = json.load(f)
-
-    with open("port_codes_reference.json", "r") as f:
-        port_reference = json.load(f)
+    emails = load_json("emails_input.json")
 
-    # 2. Load port lookups
-    code_to_name, name_to_code, code_to_all_names = load_port_reference()
+    # 2. Load port reference and lookups
+    port_reference, code_to_name, name_to_code, code_to_all_names, port_index = load_port_reference()
 
     # 3. CHECK FOR EXISTING OUTPUT (RESUME LOGIC)
-    results = []
+    # output.jsonl is the live checkpoint of an unfinished run; output.json is a finished one
     processed_ids = set()
 
-    if os.path.exists("output.json"):
+    if os.path.exists("output.jsonl"):
+        processed_ids = load_checkpoint_ids("output.jsonl")
+        print(
+            f"📂 Found checkpoint output.jsonl with {len(processed_ids)} emails")
+    elif os.path.exists("output.json"):
         try:
-            with open("output.json", "r") as f:
-                results = json.load(f)
-                processed_ids = {r["id"] for r in results}
-                print(
-                    f"📂 Found existing output.json with {len(processed_ids)} emails")
-                print(f"   Will resume from email {len(processed_ids) + 1}")
-        except (json.JSONDecodeError, FileNotFoundError):
+            results = load_json("output.json")
+            # Seed the checkpoint so this run can append to it (swapped in whole, so a
+            # crash here can't leave a partial checkpoint that shadows output.json)
+            with open("output.jsonl.tmp", "w", encoding="utf-8") as f:
+                for r in results:
+                    f.write(dumps(r) + "\n")
+            os.replace("output.jsonl.tmp", "output.jsonl")
+            processed_ids = {r["id"] for r in results}
+            print(
+                f"📂 Found existing output.json with {len(processed_ids)} emails")
+        except (JSONDecodeError, FileNotFoundError):
             print("⚠️  output.json exists but is invalid, starting fresh")
-            results = []
             processed_ids = set()
     else:
         print("📝 Starting fresh - no existing output.json")
 
-    # 4. Process each email (SKIP ALREADY PROCESSED)
-    print(f"Processing {len(emails)} emails...")
-
-    for i, email in enumerate(emails, 1):
-        email_id = email['id']
-
-        # SKIP if already processed
-        if email_id in processed_ids:
-            print(
-                f"⏭️  Skipping {i}/{len(emails)}: {email_id} (already processed)")
-            continue
-
-        print(f"🔄 Processing {i}/{len(emails)}: {email_id}")
+    # 4. Process remaining emails concurrently (SKIP ALREADY PROCESSED)
+    pending = [email for email in emails if email["id"] not in processed_ids]
+    if len(pending) < len(emails):
+        print(
+            f"⏭️  Skipping {len(emails) - len(pending)} emails (already processed)")
+
+    # Extraction depends only on subject and body, so identical emails run once
+    first_ids = {}  # (subject, body) -> ID of the first such email
+    duplicate_ids = defaultdict(list)  # first ID -> IDs of identical later emails
+    unique = []
+    for email in pending:
+        content = (email["subject"], email["body"])
+        if content in first_ids:
+            duplicate_ids[first_ids[content]].append(email["id"])
+        else:
+            first_ids[content] = email["id"]
+            unique.append(email)
+    if len(unique) < len(pending):
+        print(
+            f"🔁 {len(pending) - len(unique)} duplicate emails will reuse an identical email's result")
+
+    # Batch prompts exist for v3 only
+    batch_size = max(1, BATCH_SIZE) if PROMPT_VERSION == "v3" else 1
+    batches = [unique[i:i + batch_size]
+               for i in range(0, len(unique), batch_size)]
+    print(
+        f"Processing {len(pending)} emails in {len(batches)} requests ({MAX_CONCURRENT_REQUESTS} concurrent requests)...")
+
+    executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+    futures = {
+        executor.submit(
+            extract_email_batch,
+            batch,
+            port_reference,
+            code_to_name,
+            name_to_code,
+            port_index
+        ): [email["id"] for email in batch]
+        for batch in batches
+    }
+    done_count = len(processed_ids)
 
+    # 💾 APPEND EACH RESULT AS ONE LINE (so you don't lose progress!)
+    # Line-buffered: every record reaches the file as soon as its line is written
+    with open("output.jsonl", "a", encoding="utf-8", buffering=1) as checkpoint:
         try:
-            result = extract_single_email(
-                email,
-                port_reference,
-                code_to_name,
-                name_to_code,
-                code_to_all_names
-            )
-            results.append(result)
-
-            # 💾 SAVE AFTER EACH EMAIL (so you don't lose progress!)
-            with open("output.json", "w") as f:
-                json.dump(results, f, indent=2)
-            print(
-                f"   ✅ Saved ({len(results)}/{len(emails)} emails processed)")
+            for future in as_completed(futures):
+                email_ids = futures[future]
+                try:
+                    batch_results = future.result()
+                except Exception as e:
+                    # Stop retries and wake waiting workers; their results would be dropped
+                    stop_event.set()
+                    print(f"   ❌ Error processing {', '.join(email_ids)}: {e}")
+                    print(
+                        f"   💾 Progress saved to output.jsonl ({done_count} emails)")
+                    raise
+                for result in batch_results:
+                    copies = [dict(result, id=email_id)
+                              for email_id in duplicate_ids.get(result["id"], ())]
+                    for record in [result] + copies:
+                        checkpoint.write(dumps(record) + "\n")
+                        done_count += 1
+                        print(
+                            f"   ✅ {record['id']} done ({done_count}/{len(emails)} emails processed)")
 
         except KeyboardInterrupt:
+            stop_event.set()
             print(
-                f"\n⚠️  Interrupted! Progress saved to output.json ({len(results)} emails)")
-            raise
-        except Exception as e:
-            print(f"   ❌ Error processing {email_id}: {e}")
-            # Still save what we have
-            with open("output.json", "w") as f:
-                json.dump(results, f, indent=2)
-            print(f"   💾 Progress saved ({len(results)} emails)")
+                f"\n⚠️  Interrupted! Progress saved to output.jsonl ({done_count} emails)")
             raise
+        finally:
+            # Don't start queued emails after a failure or interrupt
+            executor.shutdown(wait=False, cancel_futures=True)
 
-        # Rate limiting: Wait 3 seconds between requests to avoid hitting limit
-        if i < len(emails):
-            time.sleep(3)
+    # 5. Write final output.json and drop the checkpoint
+    total = materialize_output("output.jsonl", "output.json", emails)
+    os.remove("output.jsonl")
 
     print(f"\n✅ Done! Results saved to output.json")
-    print(f"   Processed {len(results)} emails")
+    print(f"   Processed {total} emails")
 
 
 if __name__ == "__main__":
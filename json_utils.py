@@ -0,0 +1,50 @@
+"""
+JSON helpers shared by extract.py and evaluate.py.
+Uses orjson when it is installed (C implementation, several times faster), stdlib json otherwise.
+"""
+import json
+import os
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # orjson is optional
+    orjson = None
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so one except clause covers both
+JSONDecodeError = json.JSONDecodeError
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """Parse a JSON document from str or bytes."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> str:
+    """Serialize to a compact single-line JSON string."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def load_json(file_path: str) -> Any:
+    """Read and parse a JSON file."""
+    with open(file_path, "rb") as f:
+        return loads(f.read())
+
+
+def save_json(obj: Any, file_path: str) -> None:
+    """
+    Write obj to a JSON file, pretty-printed with 2-space indentation.
+    The file is written to a temporary path and swapped in, so readers never see a partial file.
+    """
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    if orjson is not None:
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(obj, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, file_path)
@@ -2,21 +2,51 @@
 Prompt templates for LLM extraction.
 Shows evolution: v1 (basic) → v2 (business rules) → v3 (edge cases)
 """
+import re
+from string import Formatter
+from typing import Dict, Tuple
 
 
-def create_extraction_prompt_v1(subject: str, body: str, port_reference: list) -> str:
+# Per-email fields are swapped for markers while a template is pre-rendered
+_FIELD_MARKER = "\x00{}\x00"
+_FIELD_MARKER_RE = re.compile("\x00(\\w+)\x00")
+
+# Pre-rendered templates by (template, port list identity, port count). The list is kept
+# alongside so its id can't be reused; the port reference is never mutated after loading.
+_rendered_templates: Dict[Tuple[str, int, int], Tuple[list, Tuple[str, ...]]] = {}
+
+
+def _render_template(template: str, port_reference: list, port_count: int) -> Tuple[str, ...]:
     """
-    Version 1: Basic extraction prompt.
-    Simple instructions to extract fields from email.
-    Minimal rules - just basic extraction.
+    Fill the port list into a template once and split it around its per-email fields.
+    Returns (text, field, text, field, ..., text).
     """
-    # Show first 20 ports as examples
-    port_examples = "\n".join([
-        f"- {port['name']} ({port['code']})"
-        for port in port_reference[:20]
-    ])
-
-    prompt = f"""You are an expert at extracting shipment details from freight forwarding emails.
+    key = (template, id(port_reference), port_count)
+    cached = _rendered_templates.get(key)
+    if cached is None:
+        port_examples = "\n".join([
+            f"- {port['name']} ({port['code']})"
+            for port in port_reference[:port_count]
+        ])
+        markers = {name: _FIELD_MARKER.format(name)
+                   for _, name, _, _ in Formatter().parse(template)
+                   if name and name != "port_examples"}
+        rendered = template.format(port_examples=port_examples, **markers)
+        cached = (port_reference, tuple(_FIELD_MARKER_RE.split(rendered)))
+        _rendered_templates[key] = cached
+    return cached[1]
+
+
+def _fill_template(template: str, port_reference: list, port_count: int, **fields: str) -> str:
+    """Splice the per-email fields into a pre-rendered template (ports from the reference head)."""
+    parts = list(_render_template(template, port_reference, port_count))
+    # Odd positions hold field names
+    for i in range(1, len(parts), 2):
+        parts[i] = fields[parts[i]]
+    return "".join(parts)
+
+
+_V1_TEMPLATE = """You are an expert at extracting shipment details from freight forwarding emails.
 
 Extract the following information from this email:
 
@@ -40,25 +70,18 @@ Return a JSON object with these exact fields:
 Return ONLY valid JSON, no other text. Example format:
 {{"origin_port_code": "HKHKG", "origin_port_name": "Hong Kong", "destination_port_code": "INMAA", "destination_port_name": "Chennai", "incoterm": "FOB", "cargo_weight_kg": 500.0, "cargo_cbm": 5.0, "is_dangerous": false}}"""
 
-    return prompt
-
 
-def create_extraction_prompt_v2(subject: str, body: str, port_reference: list) -> str:
+def create_extraction_prompt_v1(subject: str, body: str, port_reference: list) -> str:
     """
-    Version 2: Add business rules and port abbreviations.
-    - India detection logic
-    - Product line determination
-    - Port abbreviations mapping
-    - Multiple shipments handling
-    - RT units explanation
+    Version 1: Basic extraction prompt.
+    Simple instructions to extract fields from email.
+    Minimal rules - just basic extraction.
     """
-    port_examples = "\n".join([
-        f"- {port['name']} ({port['code']})"
-        for port in port_reference[:20]
-    ])
+    return _fill_template(_V1_TEMPLATE, port_reference, 20, subject=subject, body=body)
+
 
-    # Common port abbreviations
-    abbreviations = """
+# Common port abbreviations
+_V2_ABBREVIATIONS = """
 Common Port Abbreviations:
 - SHA, CNSHA = Shanghai
 - SIN, SGSIN = Singapore
@@ -94,7 +117,7 @@ Common Port Abbreviations:
 - TXG, CNTXG = Tianjin/Xingang
 """
 
-    prompt = f"""You are an expert at extracting shipment details from freight forwarding emails.
+_V2_TEMPLATE = """You are an expert at extracting shipment details from freight forwarding emails.
 
 Extract the following information from this email:
 
@@ -113,7 +136,7 @@ IMPORTANT RULES:
 9. Missing values should be null (not 0 or empty string)
 10. Round weight and CBM to 2 decimal places
 
-{abbreviations}
+""" + _V2_ABBREVIATIONS + """
 
 Available Port Codes (UN/LOCODE format):
 {port_examples}
@@ -132,28 +155,22 @@ Return a JSON object with these exact fields:
 
 Return ONLY valid JSON, no other text."""
 
-    return prompt
 
-
-def create_extraction_prompt_v3(subject: str, body: str, port_reference: list) -> str:
+def create_extraction_prompt_v2(subject: str, body: str, port_reference: list) -> str:
     """
-    Version 3: Comprehensive edge case handling.
-    - Multiple shipments (extract first only)
-    - Transshipment ports (ignore "via X")
-    - Comprehensive port abbreviations
-    - RT units handling
-    - ICD-specific names
-    - Better port matching
-    - Unit conversions (lbs to kg)
-    - Body vs Subject conflict resolution
+    Version 2: Add business rules and port abbreviations.
+    - India detection logic
+    - Product line determination
+    - Port abbreviations mapping
+    - Multiple shipments handling
+    - RT units explanation
     """
-    port_examples = "\n".join([
-        f"- {port['name']} ({port['code']})"
-        for port in port_reference[:25]
-    ])
+    return _fill_template(_V2_TEMPLATE, port_reference, 20, subject=subject, body=body)
 
-    # Comprehensive port abbreviations
-    abbreviations = """
+
+# v3 prompt sections shared by the single-email and batch prompts
+# Comprehensive port abbreviations
+_V3_ABBREVIATIONS = """
 Common Port Abbreviations (use these to match port codes):
 - SHA, CNSHA = Shanghai
 - SIN, SGSIN = Singapore
@@ -205,14 +222,7 @@ Special ICD Names (Indian Inland Container Depots):
 - "Bangkok ICD" or "ICD Bangkok" = THBKK
 """
 
-    prompt = f"""You are an expert at extracting shipment details from freight forwarding emails.
-
-Extract the following information from this email:
-
-Email Subject: {subject}
-Email Body: {body}
-
-CRITICAL RULES (follow in order of priority):
+_V3_RULES = """CRITICAL RULES (follow in order of priority):
 
 1. **BODY OVER SUBJECT**: If Subject and Body have conflicting information (different ports, incoterms, etc.), ALWAYS use information from Body - it has more detailed context.
 
@@ -251,16 +261,9 @@ CRITICAL RULES (follow in order of priority):
 
 11. **ROUNDING**: Round cargo_weight_kg and cargo_cbm to 2 decimal places
 
-12. **PORT NAMES**: Use canonical port name from reference file for the matched code
-
-{abbreviations}
+12. **PORT NAMES**: Use canonical port name from reference file for the matched code"""
 
-Available Port Codes (UN/LOCODE format):
-{port_examples}
-... and more ports in the reference file.
-
-Return a JSON object with these exact fields:
-- product_line: "pl_sea_import_lcl" or "pl_sea_export_lcl"
+_V3_FIELDS = """- product_line: "pl_sea_import_lcl" or "pl_sea_export_lcl"
 - origin_port_code: 5-letter UN/LOCODE or null
 - origin_port_name: Port name from reference or null
 - destination_port_code: 5-letter UN/LOCODE or null
@@ -268,8 +271,75 @@ Return a JSON object with these exact fields:
 - incoterm: FOB, CIF, CFR, EXW, DDP, DAP, FCA, CPT, CIP, or DPU
 - cargo_weight_kg: Weight in kg (number or null)
 - cargo_cbm: Volume in CBM (number or null)
-- is_dangerous: boolean
+- is_dangerous: boolean"""
+
+
+_V3_TEMPLATE = """You are an expert at extracting shipment details from freight forwarding emails.
+
+Extract the following information from this email:
+
+Email Subject: {subject}
+Email Body: {body}
+
+""" + _V3_RULES + """
+
+""" + _V3_ABBREVIATIONS + """
+
+Available Port Codes (UN/LOCODE format):
+{port_examples}
+... and more ports in the reference file.
+
+Return a JSON object with these exact fields:
+""" + _V3_FIELDS + """
 
 Return ONLY valid JSON, no other text."""
 
-    return prompt
+_V3_BATCH_TEMPLATE = """You are an expert at extracting shipment details from freight forwarding emails.
+
+Extract the following information from EACH of these {count} emails:
+
+{email_blocks}
+
+Apply every rule below to each email independently.
+
+""" + _V3_RULES + """
+
+""" + _V3_ABBREVIATIONS + """
+
+Available Port Codes (UN/LOCODE format):
+{port_examples}
+... and more ports in the reference file.
+
+Return a JSON array of exactly {count} objects, one per email, in the same order as the emails above.
+Each object has these exact fields:
+""" + _V3_FIELDS + """
+
+Return ONLY a valid JSON array, no other text."""
+
+
+def create_extraction_prompt_v3(subject: str, body: str, port_reference: list) -> str:
+    """
+    Version 3: Comprehensive edge case handling.
+    - Multiple shipments (extract first only)
+    - Transshipment ports (ignore "via X")
+    - Comprehensive port abbreviations
+    - RT units handling
+    - ICD-specific names
+    - Better port matching
+    - Unit conversions (lbs to kg)
+    - Body vs Subject conflict resolution
+    """
+    return _fill_template(_V3_TEMPLATE, port_reference, 25, subject=subject, body=body)
+
+
+def create_batch_extraction_prompt_v3(emails: list, port_reference: list) -> str:
+    """
+    Version 3 rules applied to several emails in a single prompt.
+    Emails are numbered [1]..[N]; the model returns a JSON array of N objects in the same order.
+    """
+    email_blocks = "\n\n".join([
+        f"[{i}]\nEmail Subject: {email['subject']}\nEmail Body: {email['body']}"
+        for i, email in enumerate(emails, 1)
+    ])
+    return _fill_template(_V3_BATCH_TEMPLATE, port_reference, 25,
+                          count=str(len(emails)), email_blocks=email_blocks)
@@ -1,13 +1,21 @@
 """
 Pydantic models for shipment extraction validation.
+Also provides validate_shipment(), a lightweight dict validator for the per-email hot path,
+and select_shipment_fields() for runs that skip validation entirely.
 """
-from pydantic import BaseModel, Field
-from typing import Optional
+import math
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Any, Dict, Optional, Tuple
+
+_TRUE_STRINGS = frozenset({"true", "t", "yes", "y", "on", "1"})
+_FALSE_STRINGS = frozenset({"false", "f", "no", "n", "off", "0"})
 
 
 class ShipmentExtraction(BaseModel):
     """Schema for extracted shipment details from emails."""
 
+    model_config = ConfigDict(extra="ignore", validate_assignment=False)
+
     id: str
     product_line: str
     origin_port_code: Optional[str] = None
@@ -18,3 +26,76 @@ class ShipmentExtraction(BaseModel):
     cargo_weight_kg: Optional[float] = Field(None, ge=0)
     cargo_cbm: Optional[float] = Field(None, ge=0)
     is_dangerous: bool = False
+
+
+# (field, default) in model order; required fields default to None
+_FIELD_DEFAULTS: Tuple[Tuple[str, Any], ...] = tuple(
+    (name, None if info.is_required() else info.default)
+    for name, info in ShipmentExtraction.model_fields.items())
+
+
+def _check_str(data: Dict, field: str, optional: bool = True, default: Optional[str] = None) -> Optional[str]:
+    value = data.get(field, default)
+    if value is None and optional:
+        return None
+    if isinstance(value, str):
+        return value
+    raise ValueError(f"{field}: expected a string, got {value!r}")
+
+
+def _check_non_negative_float(data: Dict, field: str) -> Optional[float]:
+    value = data.get(field)
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.strip()
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field}: expected a number, got {value!r}")
+    if math.isnan(number) or number < 0:
+        raise ValueError(f"{field}: must be a number >= 0, got {value!r}")
+    return number
+
+
+def _check_bool(data: Dict, field: str) -> bool:
+    value = data.get(field, False)
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str):
+        text = value.strip().lower()
+        if text in _TRUE_STRINGS:
+            return True
+        if text in _FALSE_STRINGS:
+            return False
+    raise ValueError(f"{field}: expected a boolean, got {value!r}")
+
+
+def validate_shipment(data: Dict) -> Dict:
+    """
+    Validate and coerce a post-processed extraction without building a Pydantic model.
+    Mirrors ShipmentExtraction(**data).model_dump(): same fields and order, extra keys
+    dropped, ValueError on invalid values.
+    """
+    return {
+        "id": _check_str(data, "id", optional=False),
+        "product_line": _check_str(data, "product_line", optional=False),
+        "origin_port_code": _check_str(data, "origin_port_code"),
+        "origin_port_name": _check_str(data, "origin_port_name"),
+        "destination_port_code": _check_str(data, "destination_port_code"),
+        "destination_port_name": _check_str(data, "destination_port_name"),
+        "incoterm": _check_str(data, "incoterm", optional=False, default="FOB"),
+        "cargo_weight_kg": _check_non_negative_float(data, "cargo_weight_kg"),
+        "cargo_cbm": _check_non_negative_float(data, "cargo_cbm"),
+        "is_dangerous": _check_bool(data, "is_dangerous"),
+    }
+
+
+def select_shipment_fields(data: Dict) -> Dict:
+    """
+    Project an extraction onto the schema fields (model order and defaults) without
+    validating anything. Only safe for data already normalized by post-processing.
+    """
+    return {field: data.get(field, default) for field, default in _FIELD_DEFAULTS}